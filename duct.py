@@ -74,7 +74,17 @@ try:
 except NameError:
     PIPE_CLOSED_ERROR = IOError
 
+IS_WINDOWS = os.name == "nt"
 HAS_WAITID = "waitid" in dir(os)
+PROC_FD_DIR = "/proc/self/fd"
+HAS_PROC_FD = os.path.isdir(PROC_FD_DIR)
+# The posix_spawn fast path relies on spawning raising an error when exec
+# fails, so that Popen can retry and raise its usual error. Older libc versions
+# report that as exit status 127 instead. subprocess only trusts posix_spawn on
+# platforms where it raises (glibc 2.24+, macOS, and Solaris), so we reuse its
+# check, and we skip the fast path on versions that don't have it.
+HAS_POSIX_SPAWN = getattr(subprocess, "_USE_POSIX_SPAWN", False)
+HAS_POSIX_SPAWN_CLOSEFROM = "POSIX_SPAWN_CLOSEFROM" in dir(os)
 
 # Expression and handle types.
 # TODO: Replace this with enum when we no longer support Python 2.
@@ -480,9 +490,15 @@ class Expression:
     def before_spawn(self, callback):
         r"""
         Add a callback for modifying the arguments to :func:`Popen` right
-        before it's called. The callback will be passed a command list (the
-        program followed by its arguments) and a keyword arguments dictionary,
-        and it may modify either. The callback's return value is ignored.
+        before each child is spawned. The callback will be passed a command
+        list (the program followed by its arguments) and a keyword arguments
+        dictionary, and it may modify either. The callback's return value is
+        ignored.
+
+        On platforms that support it, duct spawns most children with
+        :func:`os.posix_spawn` rather than :func:`Popen`. A callback that adds
+        an argument only :func:`Popen` understands, or sets ``cwd``, makes
+        that command go through :func:`Popen` instead.
 
         The callback is called for each command in its sub-expression, and each
         time the expression is executed. That call happens after other features
@@ -524,13 +540,13 @@ def start_expression(expression, context):
                                             modified_context)
 
     return Handle(expression._type, handle_inner, handle_payload_cell[0],
-                  str(expression), context.stdout_capture_context,
+                  expression, context.stdout_capture_context,
                   context.stderr_capture_context)
 
 
 def start_cmd(context, prog, args):
     prog_str = stringify_with_dot_if_path(prog)
-    maybe_absolute_prog = maybe_canonicalize_exe_path(prog_str, context)
+    maybe_absolute_prog = maybe_canonicalize_exe_path(prog_str)
     args_strs = [stringify_if_path(arg) for arg in args]
     command = [maybe_absolute_prog] + args_strs
     kwargs = {
@@ -540,9 +556,18 @@ def start_cmd(context, prog, args):
         "stdout": context.stdout,
         "stderr": context.stderr,
     }
+    hooks = context.before_spawn_hooks
+    if hooks and context.dir is None:
+        # Hooks have always seen the working directory as an absolute path,
+        # even without dir(). If they leave it alone, go back to inheriting
+        # it, which keeps the posix_spawn fast path available.
+        parent_cwd = os.getcwd()
+        kwargs["cwd"] = parent_cwd
     # The innermost hooks are pushed last, and we execute them last.
-    for hook in context.before_spawn_hooks:
+    for hook in hooks:
         hook(command, kwargs)
+    if hooks and context.dir is None and kwargs["cwd"] == parent_cwd:
+        kwargs["cwd"] = None
     return safe_popen(command, **kwargs)
 
 
@@ -582,8 +607,7 @@ def modify_context(expression, context, payload_cell):
             buf = arg
         else:
             raise TypeError("Not a valid stdin_bytes parameter: " + repr(arg))
-        input_reader = io.BytesIO(buf)
-        with start_input_thread(input_reader, payload_cell) as read_pipe:
+        with start_input_thread(buf, payload_cell) as read_pipe:
             yield context._replace(stdin=read_pipe)
 
     elif expression._type == STDIN_PATH:
@@ -714,12 +738,15 @@ class Handle:
     the children into zombie processes. In a long-running program, that could
     be serious resource leak.
     """
-    def __init__(self, _type, inner, payload, expression_str,
+    def __init__(self, _type, inner, payload, expression,
                  stdout_capture_context, stderr_capture_context):
         self._type = _type
         self._inner = inner
         self._payload = payload
-        self._expression_str = expression_str
+        # Formatting the expression is only needed for StatusError, and doing
+        # it for every sub-expression at start time would be quadratic in the
+        # depth of the expression. Keep the expression and format it lazily.
+        self._expression = expression
         self._stdout_capture_context = stdout_capture_context
         self._stderr_capture_context = stderr_capture_context
 
@@ -734,7 +761,7 @@ class Handle:
         """
         status, output = wait_on_status_and_output(self)
         if is_checked_error(status):
-            raise StatusError(output, self._expression_str)
+            raise StatusError(output, str(self._expression))
         return output
 
     def try_wait(self):
@@ -893,8 +920,9 @@ def repr_expression(expression):
 
 
 # The IOContext represents the child process environment at any given point in
-# the execution of an expression. We read the working directory and the entire
-# environment when we create a new execution context. Methods like .env(),
+# the execution of an expression. We read the entire environment when we create
+# a new execution context. The working directory is None (inherited from the
+# parent) unless .dir() sets it. Methods like .env(),
 # .dir(), and .pipe() will create new modified contexts and pass those to their
 # children. The IOContext does *not* own any of the file descriptors it's
 # holding -- it's the caller's responsibility to close those.
@@ -918,7 +946,7 @@ def new_iocontext():
         stdin=0,
         stdout=1,
         stderr=2,
-        dir=os.getcwd(),
+        dir=None,
         # Pretend this dictionary is immutable please.
         env=os.environ.copy(),
         stdout_capture_context=OutputCaptureContext(),
@@ -927,6 +955,12 @@ def new_iocontext():
     )
     try:
         yield context
+    except Exception:
+        # If spawning failed, nothing is ever going to read the capture pipes.
+        # Close them now, rather than whenever the traceback is collected.
+        context.stdout_capture_context.close_read_pipe_if_needed()
+        context.stderr_capture_context.close_read_pipe_if_needed()
+        raise
     finally:
         context.stdout_capture_context.close_write_pipe_if_needed()
         context.stderr_capture_context.close_write_pipe_if_needed()
@@ -963,7 +997,7 @@ def open_path(path_or_string, mode):
 
 
 @contextmanager
-def start_input_thread(input_reader, writer_thread_cell):
+def start_input_thread(input_bytes, writer_thread_cell):
     read, write = open_pipe()
 
     def write_thread():
@@ -973,9 +1007,12 @@ def start_input_thread(input_reader, writer_thread_cell):
         #
         # Note that on macOS, *both* write *and* close can raise a
         # BrokenPipeError. So we put the try on the outside.
+        #
+        # Writing the whole buffer in one call lets the file object pass it
+        # straight to the OS, without copying it into chunks first.
         try:
             with write:
-                shutil.copyfileobj(input_reader, write)
+                write.write(input_bytes)
         except PIPE_CLOSED_ERROR:
             pass
 
@@ -1010,6 +1047,11 @@ class OutputCaptureContext:
         if self._write_pipe is not None:
             self._write_pipe.close()
 
+    # Once a reader thread has started, it owns the read pipe and closes it.
+    def close_read_pipe_if_needed(self):
+        if self._read_pipe is not None and self._thread is None:
+            self._read_pipe.close()
+
     def start_thread_if_needed(self):
         if self._read_pipe is None:
             return
@@ -1089,11 +1131,10 @@ def open_pipe():
 #
 # We want to use the parent's cwd consistently, because that saves the caller
 # from having to worry about whether `dir` will have side effects, and because
-# it's easy for the caller to use path.join if they want to. That means that
-# when `dir` is in use, we need to detect exe names that are relative paths,
-# and absolutify them. We want to do that as little as possible though, both
-# because canonicalization can fail, and because we prefer to let the caller
-# control the child's argv[0].
+# it's easy for the caller to use path.join if they want to. That means that we
+# need to detect exe names that are relative paths, and absolutify them. We
+# want to do that as little as possible though, both because canonicalization
+# can fail, and because we prefer to let the caller control the child's argv[0].
 #
 # We never want to absolutify a name like "emacs", because that's probably a
 # program in the PATH rather than a local file. So we look for slashes in the
@@ -1106,11 +1147,11 @@ def open_pipe():
 # already, this case actually works without our help. (The thing Windows users
 # have to watch out for instead is local files shadowing global program names,
 # which I don't think we can or should prevent.)
-def maybe_canonicalize_exe_path(exe_name, iocontext):
+def maybe_canonicalize_exe_path(exe_name):
     has_sep = (os.path.sep in exe_name
                or (os.path.altsep is not None and os.path.altsep in exe_name))
 
-    if has_sep and iocontext.dir is not None and not os.path.isabs(exe_name):
+    if has_sep and not os.path.isabs(exe_name):
         return os.path.realpath(exe_name)
     else:
         return exe_name
@@ -1119,18 +1160,14 @@ def maybe_canonicalize_exe_path(exe_name, iocontext):
 popen_lock = threading.Lock()
 
 
-def is_windows():
-    return os.name == "nt"
-
-
 # This wrapper works around two major deadlock issues to do with pipes. The
-# first is that, before Python 3.2 on POSIX systems, os.pipe() creates
-# inheritable file descriptors, which leak to all child processes and prevent
-# reads from reaching EOF. The workaround for this is to set close_fds=True on
-# POSIX, which was not the default in those versions. See PEP 0446 for many
-# details.
-#
-# TODO: Revisit this workaround when we drop Python 2 support.
+# first is that inheritable file descriptors leak to all child processes and
+# prevent reads from reaching EOF. Before Python 3.4 on POSIX systems, that
+# included every os.pipe(), and even now it includes anything made inheritable
+# with os.set_inheritable() or opened by a C extension. The workaround for this
+# is to set close_fds=True on POSIX, which was not the default before Python
+# 3.2. See PEP 0446 for many details. The posix_spawn fast path below closes
+# the same descriptors with file actions.
 #
 # The second issue arises on Windows, where we're not allowed to set
 # close_fds=True while also setting stdin/stdout/stderr. Descriptors from
@@ -1140,13 +1177,148 @@ def is_windows():
 # workaround for this is to protect Popen() with a global lock. See
 # https://bugs.python.org/issue25565.
 #
-# This function also returns a SharedChild object, which wraps
-# subprocess.Popen. That type works around another race condition to do with
-# signaling children.
-def safe_popen(*args, **kwargs):
-    close_fds = not is_windows()
-    with popen_lock:
-        return SharedChild(*args, close_fds=close_fds, **kwargs)
+# This function also returns a SharedChild object, which wraps either a
+# PosixSpawnChild from the fast path or a subprocess.Popen. That type works
+# around another race condition to do with signaling children.
+def safe_popen(command, **kwargs):
+    child = maybe_posix_spawn(command, kwargs)
+    if child is None:
+        close_fds = not IS_WINDOWS
+        with popen_lock:
+            child = subprocess.Popen(command, close_fds=close_fds, **kwargs)
+    return SharedChild(child)
+
+
+POSIX_SPAWN_KWARGS = frozenset(["cwd", "env", "stdin", "stdout", "stderr"])
+
+# The same signals that subprocess.Popen resets to SIG_DFL in the child, when
+# restore_signals=True (the default). Python ignores SIGPIPE in the parent, and
+# we don't want children to inherit that.
+POSIX_SPAWN_SIGDEF = [
+    getattr(signal, name) for name in ("SIGPIPE", "SIGXFZ", "SIGXFSZ")
+    if hasattr(signal, name)
+]
+
+
+# Most commands don't use dir() or any before_spawn() hooks that add extra
+# Popen arguments, and in that case we can call os.posix_spawn directly. That
+# skips a lot of Python-level setup in subprocess.Popen, including the
+# close_fds scan, and on modern libc posix_spawn uses a vfork-style clone that
+# doesn't copy the parent's page tables. Since Python 3.4, all the descriptors
+# Python opens are non-inheritable by default (PEP 446), but descriptors that
+# something else made inheritable, with os.set_inheritable() or from a C
+# extension, would still leak into the child. Popen prevents that with
+# close_fds=True, and we need to do the same. Where POSIX_SPAWN_CLOSEFROM is
+# available, that's one file action. Otherwise we list the open descriptors in
+# /proc/self/fd and close the inheritable ones, and on platforms with neither
+# we use Popen. We only take this path when os.waitid is available, which means
+# SharedChild never calls poll() on the child. Return None if the fast path
+# doesn't apply, including when spawning fails, so that Popen can retry and
+# raise its usual error.
+def maybe_posix_spawn(command, kwargs):
+    if not HAS_POSIX_SPAWN or not HAS_WAITID:
+        return None
+    if not HAS_POSIX_SPAWN_CLOSEFROM and not HAS_PROC_FD:
+        return None
+    if set(kwargs) != POSIX_SPAWN_KWARGS or kwargs["cwd"] is not None:
+        return None
+    env = kwargs["env"]
+    if env is None:
+        return None
+    fds = [
+        fileno_or_none(kwargs["stdin"]),
+        fileno_or_none(kwargs["stdout"]),
+        fileno_or_none(kwargs["stderr"]),
+    ]
+    if None in fds:
+        return None
+    # Popen searches the child's PATH, not the parent's. When those are the
+    # same, which is almost always, let posix_spawnp search it in C. Otherwise
+    # resolve the program ourselves. We don't cache lookups, because programs
+    # can be installed or removed between calls.
+    if env.get("PATH") == os.environ.get("PATH"):
+        spawn, exe = os.posix_spawnp, command[0]
+    else:
+        spawn = os.posix_spawn
+        path = os.pathsep.join(os.get_exec_path(env))
+        exe = shutil.which(command[0], path=path)
+        if exe is None:
+            return None
+    try:
+        return PosixSpawnChild(spawn, exe, command, env, fds)
+    except OSError:
+        return None
+
+
+def fileno_or_none(f):
+    if isinstance(f, int):
+        # Negative values are subprocess.PIPE/DEVNULL/STDOUT, which only Popen
+        # knows how to handle.
+        return f if f >= 0 else None
+    if hasattr(f, "fileno"):
+        return f.fileno()
+    return None
+
+
+# Descriptors 0-2 are the child's stdin/stdout/stderr, so we skip those.
+def inheritable_fds():
+    fds = []
+    for name in os.listdir(PROC_FD_DIR):
+        fd = int(name)
+        if fd < 3:
+            continue
+        try:
+            if os.get_inheritable(fd):
+                fds.append(fd)
+        except OSError:
+            # This is the descriptor listdir() used, and it's closed by now.
+            pass
+    return fds
+
+
+# A minimal stand-in for subprocess.Popen, exposing only the parts that
+# SharedChild uses.
+class PosixSpawnChild:
+    def __init__(self, spawn, exe, command, env, fds):
+        # Redirections are applied in order, so a standard descriptor that's
+        # the source for a different target (e.g. stdout_stderr_swap) could be
+        # clobbered before it's read. Copy those out of the way first. A
+        # descriptor that's already in place but non-inheritable would be
+        # closed at exec, so copy that too, and let dup2 put it back without
+        # the close-on-exec flag, like Popen does. The copies are
+        # non-inheritable, so they don't leak into the child.
+        copies = []
+        try:
+            file_actions = []
+            for target, fd in enumerate(fds):
+                if fd < 3 and (fd != target or not os.get_inheritable(fd)):
+                    fd = os.dup(fd)
+                    copies.append(fd)
+                if fd != target:
+                    file_actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+            if HAS_POSIX_SPAWN_CLOSEFROM:
+                file_actions.append((os.POSIX_SPAWN_CLOSEFROM, 3))
+            else:
+                for fd in inheritable_fds():
+                    file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+            self.pid = spawn(exe,
+                             command,
+                             env,
+                             file_actions=file_actions,
+                             setsigdef=POSIX_SPAWN_SIGDEF)
+        finally:
+            for fd in copies:
+                os.close(fd)
+        self.returncode = None
+
+    def wait(self):
+        if self.returncode is None:
+            _, status = os.waitpid(self.pid, 0)
+            if os.WIFSIGNALED(status):
+                self.returncode = -os.WTERMSIG(status)
+            else:
+                self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
 
 
 # We could let our pipes do this for us, by opening them in universal newlines
@@ -1169,7 +1341,7 @@ def encode_with_universal_newlines(s):
 # removals in that copy won't interact properly with the inherited parent
 # environment.
 def convert_env_var_name(var):
-    if is_windows():
+    if IS_WINDOWS:
         return var.upper()
     return var
 
@@ -1197,8 +1369,8 @@ def convert_env_var_name(var):
 # Note that Windows doesn't have this problem, because child handles (unlike
 # raw PIDs) have to be explicitly closed.
 class SharedChild:
-    def __init__(self, *args, **kwargs):
-        self._child = subprocess.Popen(*args, **kwargs)
+    def __init__(self, child):
+        self._child = child
         # The child lock is only held for non-blocking calls. Threads making a
         # blocking call to os.waitid() release the child lock first. This
         # ensures that one thread can call try_wait() while another thread is
@@ -1290,7 +1462,7 @@ class SharedChild:
                 # what we actually do here is reimplement the documented
                 # behavior of Popen.kill: os.kill(pid, SIGKILL) on Unix, and
                 # Popen.terminate on Windows.
-                if is_windows():
+                if IS_WINDOWS:
                     self._child.terminate()
                 else:
                     os.kill(self._child.pid, signal.SIGKILL)
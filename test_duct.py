@@ -1,13 +1,17 @@
 # coding=UTF-8
 
+import atexit
 import binascii
+import gc
+import itertools
 import os
+import shutil
 import sys
 import tempfile
 import textwrap
-import time
+import threading
 
-from pytest import raises, mark
+from pytest import fixture, raises, mark
 
 import duct
 from duct import cmd, StatusError
@@ -18,14 +22,123 @@ try:
 except ImportError:
     has_pathlib = False
 
+IS_WINDOWS = os.name == 'nt'
 NEWLINE = os.linesep.encode()
 
 # Windows-compatible commands to mimic Unix
 # -----------------------------------------
 
 
+# All of these helpers are "simple" invocations, with no dir() and no extra
+# Popen arguments, so on platforms that support it duct spawns them with
+# os.posix_spawn. See test_posix_spawn_fast_path.
+#
+# Most helpers are small scripts, written to a temporary directory once at
+# import time. Running them with -S skips importing site, which is the largest
+# part of interpreter startup, and passing parameters through argv means we
+# don't format and compile new source code for every call.
+HELPER_SCRIPTS = {
+    "exit.py": textwrap.dedent('''\
+        import sys
+        sys.exit(int(sys.argv[1]))
+        '''),
+    "cat.py": textwrap.dedent('''\
+        import shutil
+        import sys
+        shutil.copyfileobj(sys.stdin, sys.stdout)
+        '''),
+    "echo.py": textwrap.dedent('''\
+        import sys
+        print(" ".join(sys.argv[1:]))
+        '''),
+    "echo_err.py": textwrap.dedent('''\
+        import sys
+        sys.stderr.write(" ".join(sys.argv[1:]) + "\\n")
+        '''),
+    "sleep.py": textwrap.dedent('''\
+        import sys
+        import time
+        time.sleep(float(sys.argv[1]))
+        '''),
+    "head.py": textwrap.dedent('''\
+        import os
+        import sys
+        # PyPy3 on Travis has a wonky bug where stdin and stdout can't read
+        # unicode. This is a workaround. The bug doesn't repro on Arch, though,
+        # so presumably it'll be fixed when they upgrade eventually.
+        stdin = os.fdopen(0, 'r')
+        stdout = os.fdopen(1, 'w')
+        input_str = stdin.read(int(sys.argv[1]))
+        stdout.write(input_str)
+        '''),
+    "pwd.py": textwrap.dedent('''\
+        import os
+        print(os.getcwd())
+        '''),
+    "echo_var.py": textwrap.dedent('''\
+        import os
+        import sys
+        print(os.environ.get(sys.argv[1], ""))
+        '''),
+    "replace.py": textwrap.dedent('''\
+        import sys
+        input_str = sys.stdin.read()
+        sys.stdout.write(input_str.replace(sys.argv[1], sys.argv[2]))
+        '''),
+    "zeroes.py": textwrap.dedent('''\
+        import sys
+        try:
+            while True:
+                sys.stdout.write('0')
+        except Exception:
+            pass
+        '''),
+    # The child for test_kill_with_grandchild. Where fork is available, the
+    # grandchild is a fork of the child, so that we only pay for one
+    # interpreter startup. The child only prints "started" once the grandchild
+    # exists.
+    "grandchild.py": textwrap.dedent('''\
+        import os
+        import subprocess
+        import sys
+        import time
+
+        if hasattr(os, "fork"):
+            pid = os.fork()
+            if pid == 0:
+                time.sleep(24 * 60 * 60)  # sleep for 1 day
+                os._exit(0)
+        else:
+            code = "import time; time.sleep(24 * 60 * 60)"
+            p = subprocess.Popen([sys.executable, "-c", code])
+        print("started")
+        sys.stdout.flush()
+        if hasattr(os, "fork"):
+            os.waitpid(pid, 0)
+        else:
+            p.wait()
+        '''),
+}
+
+# The helper scripts and the temp files from mktemp() share one directory,
+# which is removed at exit.
+SESSION_DIR = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, SESSION_DIR, True)
+for name, code in HELPER_SCRIPTS.items():
+    with open(os.path.join(SESSION_DIR, name), 'w') as f:
+        f.write(code)
+
+
+def helper_cmd(name, *args):
+    return cmd(sys.executable, '-S', os.path.join(SESSION_DIR, name), *args)
+
+
+# On Unix, the helpers that only need a shell builtin use sh, which starts an
+# order of magnitude faster than even python -S.
 def exit_cmd(n):
-    return cmd('python', '-c', 'import sys; sys.exit({0})'.format(n))
+    if IS_WINDOWS:
+        return helper_cmd("exit.py", str(n))
+    return cmd('sh', '-c', 'exit {0}'.format(n))
 
 
 def true():
@@ -37,49 +150,35 @@ def false():
 
 
 def cat_cmd():
-    return cmd(
-        'python', '-c',
-        'import sys, shutil; shutil.copyfileobj(sys.stdin, sys.stdout)')
+    return helper_cmd("cat.py")
 
 
 def echo_cmd(s):
-    return cmd('python', '-c', 'import sys; print(" ".join(sys.argv[1:]))', s)
+    return helper_cmd("echo.py", s)
 
 
 def echo_err_cmd(s):
-    return cmd('python', '-c',
-               'import sys; sys.stderr.write(" ".join(sys.argv[1:]) + "\\n")',
-               s)
+    return helper_cmd("echo_err.py", s)
 
 
 def sleep_cmd(seconds):
-    return cmd('python', '-c', 'import time; time.sleep({})'.format(seconds))
+    return helper_cmd("sleep.py", str(seconds))
 
 
 def head_bytes(c):
-    code = textwrap.dedent('''\
-        import os
-        # PyPy3 on Travis has a wonky bug where stdin and stdout can't read
-        # unicode. This is a workaround. The bug doesn't repro on Arch, though,
-        # so presumably it'll be fixed when they upgrade eventually.
-        stdin = os.fdopen(0, 'r')
-        stdout = os.fdopen(1, 'w')
-        input_str = stdin.read({0})
-        stdout.write(input_str)
-        '''.format(c))
-    return cmd('python', '-c', code)
+    return helper_cmd("head.py", str(c))
 
 
 def pwd():
-    return cmd('python', '-c', 'import os; print(os.getcwd())')
+    if IS_WINDOWS:
+        return helper_cmd("pwd.py")
+    return cmd('sh', '-c', 'pwd -P')
 
 
 def echo_var(var_name):
-    code = textwrap.dedent('''\
-        import os
-        print(os.environ.get("{0}", ""))
-        '''.format(var_name))
-    return cmd('python', '-c', code)
+    if IS_WINDOWS:
+        return helper_cmd("echo_var.py", var_name)
+    return cmd('sh', '-c', 'printf "%s\\n" "$' + var_name + '"')
 
 
 def echo_x():
@@ -87,22 +186,68 @@ def echo_x():
 
 
 def replace(a, b):
-    code = textwrap.dedent('''\
-        import sys
-        input_str = sys.stdin.read()
-        sys.stdout.write(input_str.replace({0}, {1}))
-        '''.format(repr(a), repr(b)))
-    return cmd('python', '-c', code)
+    return helper_cmd("replace.py", a, b)
+
+
+def zeroes_cmd():
+    return helper_cmd("zeroes.py")
 
 
 # utilities
 # ---------
 
 
+# Temp paths are just fresh names in a subdirectory of SESSION_DIR. We don't
+# need mkstemp to create and close a file, because every caller writes the file
+# before reading it.
+TEMP_DIR = os.path.join(SESSION_DIR, "tmp")
+os.mkdir(TEMP_DIR)
+temp_counter = itertools.count()
+
+
 def mktemp():
-    fd, path = tempfile.mkstemp()
-    os.close(fd)
-    return path
+    return os.path.join(TEMP_DIR, str(next(temp_counter)))
+
+
+# Read back the small files that tests redirect output into. Use raw reads in
+# binary mode (O_BINARY matters on Windows), so that what we compare is exactly
+# what the child wrote, without newline translation or buffering.
+def read_bytes(path):
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        return os.read(fd, 4096)
+    finally:
+        os.close(fd)
+
+
+PROC_FD_DIR = "/proc/self/fd"
+HAS_PROC_FD = os.path.isdir(PROC_FD_DIR)
+
+
+def open_fds():
+    return os.listdir(PROC_FD_DIR)
+
+
+# Check that every test closes all the file descriptors it opens, on platforms
+# where we can list them. Listing the directory opens one descriptor itself,
+# but it does that on both sides, so we compare counts rather than names. Tests
+# that leak on purpose are marked with leaks_fds.
+@fixture(autouse=True)
+def check_fd_leaks(request):
+    if not HAS_PROC_FD or request.node.get_closest_marker("leaks_fds"):
+        yield
+        return
+    before = open_fds()
+    yield
+    after = open_fds()
+    if len(after) > len(before):
+        # Unreferenced file objects are closed when they're collected. A full
+        # collection takes several milliseconds, so only pay for it when the
+        # cheap check above fails.
+        gc.collect()
+        after = open_fds()
+    leaked = sorted(set(after) - set(before), key=int)
+    assert len(after) <= len(before), "leaked fds: {}".format(leaked)
 
 
 # tests
@@ -144,6 +289,15 @@ def test_nonzero_status_throws():
         false().run()
 
 
+def test_status_error_message():
+    expression = false().pipe(true())
+    with raises(StatusError) as e:
+        expression.run()
+    expected = "Expression {} returned non-zero exit status: {}".format(
+        repr(expression), e.value.output)
+    assert str(e.value) == expected
+
+
 def test_unchecked():
     assert 1 == false().unchecked().run().status
     with raises(StatusError) as e:
@@ -182,16 +336,7 @@ def test_pipe():
 def test_pipe_SIGPIPE():
     '''On the left side of the pipe, run a command that outputs text forever.
     That program should receive SIGPIPE when the right side terminates.'''
-    zeroes_code = textwrap.dedent('''\
-        import sys
-        try:
-            while True:
-                sys.stdout.write('0')
-        except Exception:
-            pass
-        ''')
-    zeroes = cmd('python', '-c', zeroes_code)
-    out = zeroes.unchecked().pipe(head_bytes(5)).read()
+    out = zeroes_cmd().unchecked().pipe(head_bytes(5)).read()
     assert "00000" == out
 
 
@@ -234,6 +379,24 @@ def test_dir_with_relative_paths():
         os.chdir(current_dir)
 
 
+@mark.skipif(IS_WINDOWS, reason='uses a shell script')
+def test_relative_exe_path_is_absolutified():
+    # Relative program paths are made absolute even without dir(), so the
+    # child sees the canonical path as argv[0].
+    script_dir = mktemp()
+    os.mkdir(script_dir)
+    script = os.path.join(script_dir, "argv0.sh")
+    with open(script, "w") as f:
+        f.write('#!/bin/sh\necho "$0"\n')
+    os.chmod(script, 0o755)
+    current_dir = os.getcwd()
+    try:
+        os.chdir(script_dir)
+        assert cmd("./argv0.sh").read() == os.path.realpath(script)
+    finally:
+        os.chdir(current_dir)
+
+
 def test_env():
     # Test env with both strings and Pathlib paths.
     assert "foo" == echo_x().env('x', 'foo').read()
@@ -257,7 +420,7 @@ def test_full_env():
     # Wrap echo to preserve the SYSTEMROOT variable on Windows. Without this,
     # basic Python features like `import os` will fail.
     clear_env = {"foo": "bar"}
-    if os.name == "nt":
+    if IS_WINDOWS:
         clear_env["SYSTEMROOT"] = os.environ["SYSTEMROOT"]
     assert "bar" == echo_var("foo").full_env(clear_env).read()
     assert "" == echo_x().full_env(clear_env).env('x', 'foo').read()
@@ -292,20 +455,17 @@ def test_stdout():
     # with a file path
     temp = mktemp()
     echo_cmd("hi").stdout_path(temp).run()
-    with open(temp) as f:
-        assert 'hi\n' == f.read()
+    assert b'hi' + NEWLINE == read_bytes(temp)
     # with a Path path
     if has_pathlib:
         temp = mktemp()
         echo_cmd("hi").stdout_path(Path(temp)).run()
-        with open(temp) as f:
-            assert 'hi\n' == f.read()
+        assert b'hi' + NEWLINE == read_bytes(temp)
     # with an open file
     temp = mktemp()
     with open(temp, 'w') as f:
         echo_cmd("hi").stdout_file(f).run()
-    with open(temp) as f:
-        assert 'hi\n' == f.read()
+    assert b'hi' + NEWLINE == read_bytes(temp)
     # to /dev/null
     out = echo_cmd("hi").stdout_null().read()
     assert '' == out
@@ -320,20 +480,17 @@ def test_stderr():
     # with a file path
     temp = mktemp()
     echo_cmd("hi").stdout_to_stderr().stderr_path(temp).run()
-    with open(temp) as f:
-        assert 'hi\n' == f.read()
+    assert b'hi' + NEWLINE == read_bytes(temp)
     # with a Path path
     if has_pathlib:
         temp = mktemp()
         echo_cmd("hi").stdout_to_stderr().stderr_path(Path(temp)).run()
-        with open(temp) as f:
-            assert 'hi\n' == f.read()
+        assert b'hi' + NEWLINE == read_bytes(temp)
     # with an open file
     temp = mktemp()
     with open(temp, 'w') as f:
         echo_cmd("hi").stdout_to_stderr().stderr_file(f).run()
-    with open(temp) as f:
-        assert 'hi\n' == f.read()
+    assert b'hi' + NEWLINE == read_bytes(temp)
     # to /dev/null
     out = echo_cmd("hi").stdout_to_stderr().stderr_null().read()
     assert '' == out
@@ -350,7 +507,7 @@ def test_commands_can_be_paths():
     path = Path(tempdir, "script.bat")
     # Note that Path.open() rejects Python 2 non-unicode strings.
     with open(str(path), 'w') as f:
-        if os.name == 'nt':
+        if IS_WINDOWS:
             f.write('@echo off\n')
         else:
             f.write('#! /bin/sh\n')
@@ -392,10 +549,18 @@ def test_DaemonicThread_reraises_exceptions():
     with raises(ZeroDivisionError):
         thread.join()
 
-    # Kick off another DaemonicThread that will never exit. This tests that we
-    # set the daemon flag correctly, otherwise the whole test suite will hang
-    # at the end.
-    duct.DaemonicThread(lambda: time.sleep(1000000)).start()
+
+@mark.skipif("DUCT_SKIP_DAEMON_LEAK" in os.environ,
+             reason="leaks a thread for the rest of the session")
+def test_DaemonicThread_is_daemonic():
+    # Kick off a DaemonicThread that will never exit. This tests that we set
+    # the daemon flag correctly, otherwise the whole test suite will hang at
+    # the end. Waiting on an Event that's never set parks the thread
+    # indefinitely, without any periodic wakeups. Set DUCT_SKIP_DAEMON_LEAK to
+    # skip this in long-lived local test loops.
+    thread = duct.DaemonicThread(lambda: threading.Event().wait())
+    assert thread.daemon
+    thread.start()
 
 
 def test_invalid_io_args():
@@ -409,13 +574,17 @@ def test_invalid_io_args():
         cmd('foo').stderr_path(1.0).run()
 
 
+# More than the standard 64 KB Linux pipe buffer. This is bytes rather than a
+# string, so that stdin_bytes doesn't need to encode it.
+BROKEN_PIPE_INPUT = b'\x00' * 128 * 1024
+
+
 def test_write_error_in_input_thread():
-    '''The standard Linux pipe buffer is 64 KB, so we pipe 100 KB into a
+    '''The standard Linux pipe buffer is 64 KB, so we pipe 128 KB into a
     program that reads nothing. That will cause the writer thread to block on
     the pipe, and then that write will fail. Test that we catch this
     BrokenPipeError.'''
-    test_input = '\x00' * 100 * 1000
-    true().stdin_bytes(test_input).run()
+    true().stdin_bytes(BROKEN_PIPE_INPUT).run()
 
 
 def test_string_mode_returns_unicode():
@@ -425,24 +594,29 @@ def test_string_mode_returns_unicode():
     assert isinstance(out, type(u''))
 
 
+# The expressions for test_repr_round_trip, compiled once at import time. Use
+# single-quoted string values, because that's what repr() emits, and don't use
+# bytes literals, because Python 2 won't emit them.
+REPR_EXPRESSIONS = [
+    "cmd('foo').stdin_bytes('a').stdout_capture().stderr_capture()",
+    "cmd('foo').stdin_path('a').stdout_path('b').stderr_path('c')",
+    "cmd('foo').stdin_file(0).stdout_file(0).stderr_file(0)",
+    "cmd('foo').stdin_null().stdout_null().stderr_null()",
+    "cmd('foo').stdout_to_stderr().stderr_to_stdout()",
+    "cmd('foo').stdout_stderr_swap().before_spawn(0)",
+    "cmd('foo').env('a', 'b').full_env({}).env_remove('c')",
+    "cmd('foo').pipe(cmd('bar').dir('stuff').unchecked())",
+]
+REPR_EXPRESSIONS_COMPILED = [
+    compile(expression, '<test>', 'eval') for expression in REPR_EXPRESSIONS
+]
+
+
 def test_repr_round_trip():
     '''Check that our repr() output is exactly the same as the syntax used to
-    create the expression. Use single-quoted string values, because that's what
-    repr() emits, and don't use bytes literals, because Python 2 won't emit
-    them.'''
-
-    expressions = [
-        "cmd('foo').stdin_bytes('a').stdout_capture().stderr_capture()",
-        "cmd('foo').stdin_path('a').stdout_path('b').stderr_path('c')",
-        "cmd('foo').stdin_file(0).stdout_file(0).stderr_file(0)",
-        "cmd('foo').stdin_null().stdout_null().stderr_null()",
-        "cmd('foo').stdout_to_stderr().stderr_to_stdout()",
-        "cmd('foo').stdout_stderr_swap().before_spawn(0)",
-        "cmd('foo').env('a', 'b').full_env({}).env_remove('c')",
-        "cmd('foo').pipe(cmd('bar').dir('stuff').unchecked())",
-    ]
-    for expression in expressions:
-        assert repr(eval(expression)) == expression
+    create the expression.'''
+    for expression, code in zip(REPR_EXPRESSIONS, REPR_EXPRESSIONS_COMPILED):
+        assert repr(eval(code)) == expression
 
 
 def test_swap_and_redirect_at_same_time():
@@ -458,7 +632,7 @@ def test_run_local_path():
     '''Trying to execute 'test.sh' without the leading dot fails in bash and
     subprocess.py. But it needs to succeed with Path('test.sh'), because
     there's no difference between that and Path('./test.sh').'''
-    if os.name == 'nt':
+    if IS_WINDOWS:
         extension = '.bat'
         code = textwrap.dedent(u'''\
             @echo off
@@ -555,6 +729,21 @@ def test_right_side_fails_to_start():
     assert e2.value.errno == not_found_errno
 
 
+@mark.skipif(not HAS_PROC_FD, reason='can\'t list open file descriptors')
+def test_capture_pipes_closed_when_spawn_fails():
+    before = len(open_fds())
+    with raises(PROGRAM_NOT_FOUND_ERROR) as e:
+        cmd("nonexistent_command_abc123")\
+            .stdout_capture()\
+            .stderr_capture()\
+            .run()
+    # The traceback in e references the capture contexts, and it stays alive
+    # until we delete it below, so this checks that the pipes were closed
+    # explicitly rather than collected.
+    assert len(open_fds()) == before
+    del e
+
+
 def test_before_spawn():
     def callback_inner(command, kwargs):
         command.append("inner")
@@ -567,6 +756,118 @@ def test_before_spawn():
     assert out == "some outer inner"
 
 
+HAS_POSIX_SPAWN_FAST_PATH = (
+    duct.HAS_POSIX_SPAWN and duct.HAS_WAITID
+    and (duct.HAS_POSIX_SPAWN_CLOSEFROM or duct.HAS_PROC_FD))
+
+
+@mark.skipif(not HAS_POSIX_SPAWN_FAST_PATH,
+             reason='no posix_spawn fast path on this platform')
+def test_posix_spawn_fast_path(monkeypatch):
+    spawned = []
+    PosixSpawnChild = duct.PosixSpawnChild
+
+    class RecordingChild(PosixSpawnChild):
+        def __init__(self, spawn, exe, command, env, fds):
+            spawned.append(command)
+            PosixSpawnChild.__init__(self, spawn, exe, command, env, fds)
+
+    monkeypatch.setattr(duct, "PosixSpawnChild", RecordingChild)
+
+    # Simple helpers, including pipes and redirections, take the fast path.
+    assert "ho" == echo_cmd("hi").pipe(replace("i", "o")).read()
+    assert len(spawned) == 2
+    assert 1 == false().unchecked().stdout_stderr_swap().run().status
+    assert len(spawned) == 3
+
+    # dir() needs Popen's cwd support.
+    pwd().dir(tempfile.gettempdir()).read()
+    assert len(spawned) == 3
+
+
+@mark.skipif(not HAS_POSIX_SPAWN_FAST_PATH,
+             reason='no posix_spawn fast path on this platform')
+def test_posix_spawn_non_inheritable_stdout():
+    # A non-inheritable descriptor that's already sitting on fd 1 still needs
+    # to reach the child.
+    path = mktemp()
+    saved_stdout = os.dup(1)
+    log = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        os.dup2(log, 1, inheritable=False)
+        status = echo_cmd("hi").unchecked().run().status
+    finally:
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+        os.close(log)
+    assert status == 0
+    assert read_bytes(path) == b"hi" + NEWLINE
+
+
+def inheritable_fd_reaches_child(wrap):
+    read_fd, write_fd = os.pipe()
+    try:
+        os.set_inheritable(write_fd, True)
+        # The test builtin doesn't open any descriptors of its own.
+        script = 'test -e /proc/self/fd/{0}'.format(write_fd)
+        status = wrap(cmd('sh', '-c', script)).unchecked().run().status
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+    return status == 0
+
+
+@mark.skipif(not HAS_PROC_FD or not hasattr(os, "set_inheritable"),
+             reason='needs /proc/self/fd and os.set_inheritable')
+def test_popen_closes_inheritable_fds():
+    # dir() sends this command through Popen, which should close descriptors
+    # that were made inheritable, rather than leaking them into the child.
+    assert not inheritable_fd_reaches_child(lambda c: c.dir(SESSION_DIR))
+
+
+@mark.skipif(not HAS_PROC_FD or not HAS_POSIX_SPAWN_FAST_PATH,
+             reason='needs /proc/self/fd and the posix_spawn fast path')
+def test_posix_spawn_closes_inheritable_fds(monkeypatch):
+    spawned = []
+    PosixSpawnChild = duct.PosixSpawnChild
+
+    class RecordingChild(PosixSpawnChild):
+        def __init__(self, spawn, exe, command, env, fds):
+            spawned.append(command)
+            PosixSpawnChild.__init__(self, spawn, exe, command, env, fds)
+
+    monkeypatch.setattr(duct, "PosixSpawnChild", RecordingChild)
+
+    assert not inheritable_fd_reaches_child(lambda c: c)
+    assert len(spawned) == 1
+
+
+def test_before_spawn_sees_absolute_cwd():
+    seen = []
+
+    def callback(command, kwargs):
+        seen.append(kwargs["cwd"])
+
+    true().before_spawn(callback).run()
+    true().before_spawn(callback).dir(SESSION_DIR).run()
+    assert seen == [os.getcwd(), SESSION_DIR]
+
+
+def test_before_spawn_extra_popen_kwargs(monkeypatch):
+    # Hooks that add Popen-only arguments need to take the Popen path rather
+    # than the posix_spawn fast path.
+    def fail_to_spawn(*args):
+        raise AssertionError("took the posix_spawn path")
+
+    monkeypatch.setattr(duct, "PosixSpawnChild", fail_to_spawn)
+
+    def callback(command, kwargs):
+        kwargs["bufsize"] = 0
+
+    out = echo_cmd("hi").before_spawn(callback).read()
+    assert out == "hi"
+
+
 def test_stdout_stderr_swap():
     output = echo_cmd("err")\
         .stdout_to_stderr()\
@@ -629,6 +930,8 @@ def test_reader_with():
         reader.read()
 
 
+# The stderr capture thread is blocked on the grandchild forever.
+@mark.leaks_fds
 def test_kill_with_grandchild():
     # We're going to start a child process, and that child is going to start a
     # grandchild. The grandchild is going to sleep forever. We'll read some
@@ -640,60 +943,41 @@ def test_kill_with_grandchild():
     #
     # This test leaks the grandchild process. I'm sorry.
 
-    grandchild_code = r"""
-import time
-
-time.sleep(24 * 60 * 60)  # sleep for 1 day
-"""
-
-    child_code = r"""
-import subprocess
-import sys
-
-p = subprocess.Popen(["python", "-c", '''{}'''])
-print("started")
-sys.stdout.flush()
-p.wait()
-""".format(grandchild_code)
-
     # Capturing stderr means an IO thread is spawned, even though we're using a
     # ReaderHandle to read stdout. What we're testing here is that kill()
     # doesn't wait on that IO thread.
-    reader = cmd("python", "-c", child_code).stderr_capture().reader()
+    reader = helper_cmd("grandchild.py").stderr_capture().reader()
     # Read "started" from the child to make sure we don't kill it before it
     # starts the grandchild.
     assert reader.read(7) == b"started"
     # Ok, this had better not block!
     reader.kill()
     # Incidentally this also implicitly tests that background threads are
-    # daemonic, like test_DaemonicThread_reraises_exceptions does. Otherwise
-    # the test suite will block on exit.
+    # daemonic, like test_DaemonicThread_is_daemonic does. Otherwise the test
+    # suite will block on exit.
 
 
 def test_pids():
-    handle = echo_cmd("hi").start()
-    assert len(handle.pids()) == 1
-    assert type(handle.pids()[0]) is int
-    handle.wait()
-
-    reader = echo_cmd("hi").reader()
-    assert len(reader.pids()) == 1
-    assert type(reader.pids()[0]) is int
-    reader.read()
-
-    handle = echo_cmd("hi").pipe(cat_cmd().stdout_null().pipe(
+    # Start everything before waiting on anything, so that the spawns overlap.
+    handle1 = echo_cmd("hi").start()
+    reader1 = echo_cmd("hi").reader()
+    handle3 = echo_cmd("hi").pipe(cat_cmd().stdout_null().pipe(
         cat_cmd())).start()
-    assert len(handle.pids()) == 3
-    assert type(handle.pids()[0]) is int
-    assert type(handle.pids()[1]) is int
-    handle.wait()
-
-    reader = echo_cmd("hi").pipe(cat_cmd().stdout_null().pipe(
+    reader3 = echo_cmd("hi").pipe(cat_cmd().stdout_null().pipe(
         cat_cmd())).reader()
-    assert len(reader.pids()) == 3
-    assert type(reader.pids()[0]) is int
-    assert type(reader.pids()[1]) is int
-    reader.read()
+
+    for h in (handle1, reader1):
+        assert len(h.pids()) == 1
+        assert type(h.pids()[0]) is int
+    for h in (handle3, reader3):
+        assert len(h.pids()) == 3
+        assert type(h.pids()[0]) is int
+        assert type(h.pids()[1]) is int
+
+    handle1.wait()
+    reader1.read()
+    handle3.wait()
+    reader3.read()
 
 
 # This test was added after the release of Python 3.9, which included a